@@ -20,6 +20,10 @@ class ArtworkItem(scrapy.Item):
     vote_count = scrapy.Field()
     metacritic_score = scrapy.Field()
     poster_link = scrapy.Field()
+    poster_path = scrapy.Field()
+    poster_width = scrapy.Field()
+    poster_height = scrapy.Field()
+    poster_thumb_path = scrapy.Field()
     audience = scrapy.Field()
     casting = scrapy.Field()
     countries = scrapy.Field()
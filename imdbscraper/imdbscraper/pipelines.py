@@ -5,11 +5,26 @@
 
 
 # useful for handling different item types with a single interface
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import io
+import multiprocessing
+import os
 import re
 import sqlite3
+import tempfile
 
 from itemadapter import ItemAdapter
 from loguru import logger
+import scrapy
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.defer import maybe_deferred_to_future
+
+try:
+    from PIL import Image
+except ImportError:  # Posters are optional, Pillow is only needed for them
+    Image = None
 
 
 CHANGE_TO_DOLLAR = {
@@ -31,6 +46,19 @@ TEXT_FIELDS = ("id", "kind", "title", "original_title", "genres",
 INTEGER_FIELDS = ("duration_s", "release_year", "vote_count", "metacritic_score")
 MONEY_FIELDS = ("budget", "worldwide_gross")
 MONEY_PATTERN = r"(?P<currency>\D{1,3})(?P<amount>\S*)"
+POSTER_COLUMNS = {
+    "poster_path": "TEXT",
+    "poster_width": "INTEGER",
+    "poster_height": "INTEGER",
+    "poster_thumb_path": "TEXT",
+}
+POSTER_EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp", "GIF": ".gif"}
+# Only these statuses are recorded as failures, others may be transient
+POSTER_GONE_STATUSES = (404, 410)
+
+
+class UnreadablePosterError(Exception):
+    pass
 
 
 class CleanArtworkPipeline:
@@ -81,6 +109,202 @@ class CleanArtworkPipeline:
         return item
 
 
+def write_once(store, path, data):
+    """Atomically write `data` to `store/path`, unless it's already there."""
+    full_path = os.path.join(store, path)
+    if os.path.exists(full_path):
+        return
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(full_path), delete=False) as tmp:
+        try:
+            tmp.write(data)
+        except BaseException:
+            tmp.close()
+            os.unlink(tmp.name)
+            raise
+    try:
+        # Temporary files are private, the store must be readable by consumers
+        os.chmod(tmp.name, 0o644)
+        os.replace(tmp.name, full_path)
+    except BaseException:
+        os.unlink(tmp.name)
+        raise
+
+
+def poster_extension(image):
+    return POSTER_EXTENSIONS.get(image.format, f".{image.format.lower()}")
+
+
+def thumb_path_for(path, thumb_size):
+    """Thumbnail path of the stored poster `path`, for the given size."""
+    digest = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join("thumbs", "{}x{}".format(*thumb_size), digest[:2], digest + ".jpg")
+
+
+def write_thumbnail(store, image, thumb_path, thumb_size):
+    if os.path.exists(os.path.join(store, thumb_path)):
+        return
+    thumb = image.convert("RGB")
+    thumb.thumbnail(thumb_size)
+    buffer = io.BytesIO()
+    thumb.save(buffer, "JPEG", quality=85)
+    write_once(store, thumb_path, buffer.getvalue())
+
+
+def store_poster(body, store, thumb_size):
+    """
+    Store a poster under its SHA-1 digest and build its thumbnail.
+    Runs in a worker process, returns (path, width, height) with `path`
+    relative to `store`.
+    """
+    digest = hashlib.sha1(body).hexdigest()
+    try:
+        image = Image.open(io.BytesIO(body))
+        # Decode it all before storing, so corrupt posters leave no file
+        image.load()
+    except (OSError, Image.DecompressionBombError) as e:
+        raise UnreadablePosterError(f"{type(e).__name__}: {e}") from None
+    with image:
+        width, height = image.size
+        path = os.path.join("full", digest[:2], digest + poster_extension(image))
+        write_once(store, path, body)
+        write_thumbnail(store, image, thumb_path_for(path, thumb_size), thumb_size)
+    return path, width, height
+
+
+def build_thumbnail(store, path, thumb_size):
+    """Build the thumbnail of an already stored poster, in a worker process."""
+    with Image.open(os.path.join(store, path)) as image:
+        write_thumbnail(store, image, thumb_path_for(path, thumb_size), thumb_size)
+
+
+class PosterPipeline:
+    """
+    Download posters into a content-addressed store, so that posters shared
+    by several artworks are kept once. Disabled unless POSTERS_STORE is set.
+    """
+    def __init__(self, crawler, store, thumb_size, workers):
+        self.crawler = crawler
+        self.store = store
+        self.thumb_size = thumb_size
+        self.workers = workers
+        self.pending = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not (store := settings.get("POSTERS_STORE")):
+            raise NotConfigured("POSTERS_STORE is not set")
+        if Image is None:
+            raise NotConfigured("Pillow is required to store posters")
+        thumb_size = tuple(int(side) for side in settings.getlist("POSTERS_THUMB_SIZE", [182, 268]))
+        workers = settings.getint("POSTERS_WORKERS") or None
+        return cls(crawler, store, thumb_size, workers)
+
+    def open_spider(self, spider):
+        os.makedirs(self.store, exist_ok=True)
+        # Forking from the running reactor, which has threads, may deadlock
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context(method))
+        # Maps poster URLs to their stored files, or to the reason they
+        # couldn't be stored, so that later runs skip them
+        self.con = sqlite3.connect(os.path.join(self.store, "index.db"))
+        self.con.execute("""
+                         CREATE TABLE IF NOT EXISTS poster(
+                            url TEXT PRIMARY KEY,
+                            path TEXT,
+                            width INTEGER,
+                            height INTEGER,
+                            error TEXT
+                         )
+                         """)
+        columns = {row[1] for row in self.con.execute("PRAGMA table_info(poster)")}
+        if "error" not in columns:
+            self.con.execute("ALTER TABLE poster ADD COLUMN error TEXT")
+        self.con.commit()
+
+    async def process_item(self, item, spider):
+        adapter = ItemAdapter(item)
+        if not (url := adapter.get("poster_link")):
+            return item
+        # Artworks sharing a poster URL wait for the same download
+        if url not in self.pending:
+            self.pending[url] = asyncio.ensure_future(self.get_poster(url))
+            self.pending[url].add_done_callback(lambda _: self.pending.pop(url, None))
+        poster = await self.pending[url]
+
+        if poster is not None:
+            path, adapter["poster_width"], adapter["poster_height"] = poster
+            adapter["poster_path"] = path
+            adapter["poster_thumb_path"] = thumb_path_for(path, self.thumb_size)
+        return item
+
+    async def get_poster(self, url):
+        """
+        Return the (path, width, height) of the poster at `url`, or None if
+        it can't be stored. Failures are logged here, once per URL, and never
+        fail the item: posters are optional.
+        """
+        try:
+            return await self.fetch_poster(url)
+        except Exception as e:
+            logger.error(f"Poster {url} failed: {type(e)}: {e}")
+            return None
+
+    async def fetch_poster(self, url):
+        loop = asyncio.get_running_loop()
+        row = self.con.execute(
+            "SELECT path, width, height, error FROM poster WHERE url = ?", (url,)
+        ).fetchone()
+        if row is not None and row[3] is not None:
+            logger.debug(f"Skipping poster {url}: {row[3]}")
+            return None
+        if row is not None and os.path.exists(os.path.join(self.store, row[0])):
+            thumb_path = thumb_path_for(row[0], self.thumb_size)
+            if not os.path.exists(os.path.join(self.store, thumb_path)):
+                await loop.run_in_executor(
+                    self.pool, build_thumbnail, self.store, row[0], self.thumb_size
+                )
+            return row[:3]
+
+        # Offsite filtering would drop the CDN host, hence `dont_filter`
+        request = scrapy.Request(url, dont_filter=True)
+        engine = self.crawler.engine
+        if hasattr(engine, "download_async"):  # Scrapy >= 2.14
+            response = await engine.download_async(request)
+        else:
+            response = await maybe_deferred_to_future(engine.download(request))
+        if response.status in POSTER_GONE_STATUSES:
+            return self.record_failure(url, f"HTTP {response.status}")
+        if response.status != 200:
+            logger.warning(f"Poster {url} answered with status {response.status}")
+            return None
+        try:
+            poster = await loop.run_in_executor(
+                self.pool, store_poster, response.body, self.store, self.thumb_size
+            )
+        except UnreadablePosterError as e:
+            return self.record_failure(url, f"unreadable image ({e})")
+
+        self.con.execute(
+            "INSERT OR REPLACE INTO poster (url, path, width, height) VALUES (?, ?, ?, ?)",
+            (url, *poster),
+        )
+        self.con.commit()
+        return poster
+
+    def record_failure(self, url, error):
+        logger.warning(f"Poster {url} can't be stored: {error}")
+        self.con.execute("INSERT OR REPLACE INTO poster (url, error) VALUES (?, ?)", (url, error))
+        self.con.commit()
+        return None
+
+    @logger.catch
+    def close_spider(self, spider):
+        self.pool.shutdown()
+        self.con.close()
+
+
 class StoreSQLitePipeline:
     def __init__(self):
         self.con = sqlite3.connect("imdb.db")
@@ -108,9 +332,19 @@ class StoreSQLitePipeline:
                             worldwide_gross INTEGER,
                             casting TEXT,
                             synopsis TEXT,
-                            poster_link TEXT
+                            poster_link TEXT,
+                            poster_path TEXT,
+                            poster_width INTEGER,
+                            poster_height INTEGER,
+                            poster_thumb_path TEXT
                          )
                          """)
+        # Databases created before the poster pipeline lack its columns
+        columns = {row[1] for row in self.cur.execute("PRAGMA table_info(media)")}
+        for name, kind in POSTER_COLUMNS.items():
+            if name not in columns:
+                self.cur.execute(f"ALTER TABLE media ADD COLUMN {name} {kind}")
+        self.con.commit()
     
     @logger.catch
     def process_item(self, item, spider):
@@ -121,8 +355,10 @@ class StoreSQLitePipeline:
             id, kind, title, original_title, genres, duration_s,
             release_year, end_year, rating, vote_count, metacritic_score,
             audience, countries, budget, worldwide_gross,
-            casting, synopsis, poster_link
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            casting, synopsis, poster_link,
+            poster_path, poster_width, poster_height, poster_thumb_path
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,
+                      ?, ?, ?, ?)
             """,
             (
                 adapter.get("id"),
@@ -142,7 +378,11 @@ class StoreSQLitePipeline:
                 adapter.get("worldwide_gross"),
                 adapter.get("casting"),
                 adapter.get("synopsis"),
-                adapter.get("poster_link")
+                adapter.get("poster_link"),
+                adapter.get("poster_path"),
+                adapter.get("poster_width"),
+                adapter.get("poster_height"),
+                adapter.get("poster_thumb_path"),
             )
         )
         self.con.commit()
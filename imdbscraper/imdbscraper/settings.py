@@ -65,9 +65,17 @@ DEFAULT_REQUEST_HEADERS = {
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
    "imdbscraper.pipelines.CleanArtworkPipeline": 300,
+   "imdbscraper.pipelines.PosterPipeline": 350,
    "imdbscraper.pipelines.StoreSQLitePipeline": 400,
 }
 
+# Download posters into a content-addressed store (requires Pillow).
+# The poster pipeline stays disabled as long as POSTERS_STORE is unset.
+#POSTERS_STORE = "posters"
+#POSTERS_THUMB_SIZE = (182, 268)
+# Number of processes building thumbnails (default: number of CPUs)
+#POSTERS_WORKERS = 4
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
 #AUTOTHROTTLE_ENABLED = True
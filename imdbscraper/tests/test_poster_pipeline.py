@@ -0,0 +1,181 @@
+import functools
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+
+import pytest
+import scrapy
+
+from imdbscraper.items import ArtworkItem
+
+Image = pytest.importorskip("PIL.Image")
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Reactors can't be restarted, so each crawl runs in its own process
+CRAWL = """
+import json, sys
+from scrapy.crawler import CrawlerProcess
+from scrapy.utils.project import get_project_settings
+from tests.test_poster_pipeline import PosterSpider
+
+settings = get_project_settings()
+settings.setdict(json.loads(sys.argv[1]), priority="cmdline")
+process = CrawlerProcess(settings)
+crawler = process.create_crawler(PosterSpider)
+process.crawl(crawler, base_url=sys.argv[2])
+process.start()
+print(json.dumps(crawler.stats.get_stats(), default=str))
+"""
+
+
+class PosterSpider(scrapy.Spider):
+    """Yield artworks whose posters are served by a local file server."""
+    name = "posters"
+    posters = {
+        "tt1": "a.png",
+        "tt2": "b.png",
+        "tt3": "bad.jpg",
+        "tt4": "bad.jpg",
+        "tt5": "cut.jpg",
+        "tt6": "missing.jpg",
+        "tt7": "busy.jpg",
+    }
+
+    def __init__(self, base_url, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.start_urls = [base_url]
+
+    def parse(self, response):
+        for id, poster in self.posters.items():
+            yield ArtworkItem(id=id, poster_link=response.urljoin(poster))
+
+
+class Handler(SimpleHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/busy.jpg":
+            self.send_error(429)
+        else:
+            super().do_GET()
+
+
+@pytest.fixture
+def server(tmp_path):
+    served = tmp_path / "served"
+    served.mkdir()
+    buffer = served / "a.png"
+    Image.new("RGB", (300, 450), "red").save(buffer)
+    (served / "b.png").write_bytes(buffer.read_bytes())
+    (served / "bad.jpg").write_text("not an image")
+    Image.new("RGB", (300, 450), "blue").save(served / "full.jpg")
+    jpeg = (served / "full.jpg").read_bytes()
+    (served / "cut.jpg").write_bytes(jpeg[:len(jpeg) // 2])
+
+    handler = functools.partial(Handler, directory=served)
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_port}/"
+    httpd.shutdown()
+
+
+def crawl(tmp_path, base_url, **settings):
+    settings = {
+        "ITEM_PIPELINES": {
+            "imdbscraper.pipelines.CleanArtworkPipeline": 300,
+            "imdbscraper.pipelines.PosterPipeline": 350,
+        },
+        "POSTERS_STORE": str(tmp_path / "posters"),
+        "RETRY_ENABLED": False,
+        "FEEDS": {str(tmp_path / "items.json"): {"format": "json", "overwrite": True}},
+        **settings,
+    }
+    env = dict(os.environ, PYTHONPATH=PROJECT_DIR, SCRAPY_SETTINGS_MODULE="imdbscraper.settings")
+    result = subprocess.run(
+        [sys.executable, "-c", CRAWL, json.dumps(settings), base_url],
+        cwd=tmp_path, env=env, capture_output=True, text=True, check=True,
+    )
+    assert "download() is deprecated" not in result.stderr
+    items = json.loads((tmp_path / "items.json").read_text())
+    return json.loads(result.stdout), {item["id"]: item for item in items}
+
+
+def index_errors(tmp_path):
+    with sqlite3.connect(tmp_path / "posters" / "index.db") as con:
+        return dict(con.execute("SELECT url, error FROM poster WHERE error IS NOT NULL"))
+
+
+def test_posters_are_stored_once_and_skipped_later(tmp_path, server):
+    stats, items = crawl(tmp_path, server)
+    # The listing page, then each distinct poster once
+    assert stats["downloader/request_count"] == 7
+
+    store = tmp_path / "posters"
+    first, second = items["tt1"], items["tt2"]
+    assert first["poster_path"] == second["poster_path"]
+    assert first["poster_path"].endswith(".png")
+    assert (first["poster_width"], first["poster_height"]) == (300, 450)
+    assert len(list((store / "full").rglob("*.png"))) == 1
+    with Image.open(store / first["poster_thumb_path"]) as thumb:
+        assert thumb.size == (179, 268)
+    assert oct((store / first["poster_path"]).stat().st_mode & 0o777) == "0o644"
+    assert len(list((store / "full").rglob("*.jpg"))) == 0
+    for id in ("tt3", "tt5", "tt6", "tt7"):
+        assert "poster_path" not in items[id]
+
+    errors = index_errors(tmp_path)
+    assert errors[server + "missing.jpg"] == "HTTP 404"
+    assert errors[server + "bad.jpg"].startswith("unreadable image")
+    assert errors[server + "cut.jpg"].startswith("unreadable image")
+    # Rate limiting is transient, so it isn't recorded
+    assert server + "busy.jpg" not in errors
+
+    stats, items = crawl(tmp_path, server)
+    # The listing page, then busy.jpg again
+    assert stats["downloader/request_count"] == 2
+    assert items["tt1"]["poster_path"] == first["poster_path"]
+    assert "poster_path" not in items["tt4"]
+
+
+def test_thumbnails_follow_thumb_size(tmp_path, server):
+    crawl(tmp_path, server)
+    stats, items = crawl(tmp_path, server, POSTERS_THUMB_SIZE=[100, 150])
+
+    # The listing page and busy.jpg, the thumbnails come from the store
+    assert stats["downloader/request_count"] == 2
+    thumb_path = items["tt1"]["poster_thumb_path"]
+    assert thumb_path.startswith(os.path.join("thumbs", "100x150"))
+    with Image.open(tmp_path / "posters" / thumb_path) as thumb:
+        assert thumb.size == (100, 150)
+
+
+def test_old_media_table_gets_poster_columns(tmp_path, server):
+    with sqlite3.connect(tmp_path / "imdb.db") as con:
+        con.execute("CREATE TABLE media(id TEXT PRIMARY KEY, kind TEXT, title TEXT, "
+                    "original_title TEXT, genres TEXT, duration_s INTEGER, "
+                    "release_year INTEGER, end_year INTEGER, rating REAL, "
+                    "vote_count INTEGER, metacritic_score INTEGER, audience TEXT, "
+                    "countries TEXT, budget INTEGER, worldwide_gross INTEGER, "
+                    "casting TEXT, synopsis TEXT, poster_link TEXT)")
+    con.close()
+
+    crawl(tmp_path, server, ITEM_PIPELINES={
+        "imdbscraper.pipelines.CleanArtworkPipeline": 300,
+        "imdbscraper.pipelines.PosterPipeline": 350,
+        "imdbscraper.pipelines.StoreSQLitePipeline": 400,
+    })
+
+    with sqlite3.connect(tmp_path / "imdb.db") as con:
+        rows = {row[0]: row[1:] for row in con.execute(
+            "SELECT id, poster_path, poster_width, poster_height, poster_thumb_path FROM media"
+        )}
+    con.close()
+    assert len(rows) == len(PosterSpider.posters)
+    path, width, height, thumb_path = rows["tt1"]
+    assert (width, height) == (300, 450)
+    assert (tmp_path / "posters" / path).exists()
+    assert (tmp_path / "posters" / thumb_path).exists()
+    assert rows["tt6"] == (None, None, None, None)